@@ -1,20 +1,46 @@
+import argparse
+import logging
 import os
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import unicodedata
 import re
-from datetime import datetime, timezone
-from dateutil.parser import parse as parse_date
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from itertools import chain
+from urllib3.util.retry import Retry
+
+# orjson decodes large GitHub payloads several times faster; fall back to json when absent
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# ijson parses a JSON array one element at a time, so a transform can drop fields
+# before the whole page is in memory; without it pages are decoded in one go
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
 
 # Env Variables
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 REPO = os.getenv("REPO")
 CHECK_PROJECT_STATUS = os.getenv("CHECK_PROJECT_STATUS", "false").lower() == "true"
+CACHE_FILE = os.getenv("ISSUE_CACHE_FILE", ".github/.issue_cache.json")
+INCREMENTAL = os.getenv("INCREMENTAL", "false").lower() == "true"
+MIN_AGE_DAYS = os.getenv("MIN_AGE_DAYS")
 
-if not GITHUB_TOKEN or not REPO or "/" not in REPO:
-    raise Exception("❌ GITHUB_TOKEN or REPO not set or invalid format.")
-
-REPO_OWNER, REPO_NAME = REPO.strip().split("/")
+# Validated in main() so the helpers can be imported without a configured environment
+REPO_OWNER, _, REPO_NAME = (REPO or "").strip().partition("/")
 HEADERS = {
     "Authorization": f"Bearer {GITHUB_TOKEN}",
     "Accept": "application/vnd.github+json"
@@ -22,165 +48,643 @@ HEADERS = {
 
 # Constants
 REQUIRED_PRIMARY_LABEL = "Normal Change Request"
-REQUIRED_SECONDARY_LABELS = {"Application", "Infrastructure"}
+REQUIRED_SECONDARY_LABELS = frozenset({"Application", "Infrastructure"})
 LABELS_TO_ADD_ON_CLOSE = "Resolution/Done"
-REQUIRED_CHECKLIST = {
+PROJECT_STATUS_FIELD = "Status"
+REQUIRED_CHECKLIST = frozenset({
     "assessed", "authorized", "scheduled", "implemented", "reviewed"
-}
+})
+
+# Labels the gates care about, one bit each, so an issue's labels fold into a single int
+PRIMARY_LABEL_BIT = 1
+DONE_LABEL_BIT = 2
+SECONDARY_LABEL_BITS = {label: 4 << i for i, label in enumerate(sorted(REQUIRED_SECONDARY_LABELS))}
+SECONDARY_LABEL_MASK = sum(SECONDARY_LABEL_BITS.values())
+LABEL_BITS = {REQUIRED_PRIMARY_LABEL: PRIMARY_LABEL_BIT, "done": DONE_LABEL_BIT, **SECONDARY_LABEL_BITS}
+MAX_WORKERS = 10
+COMMENTS_PER_PAGE = 100
+PROJECT_STATUS_BATCH_SIZE = 50
+SEARCH_RESULT_LIMIT = 1000
+MAX_RATE_LIMIT_RETRIES = 5
+MIN_CORE_REMAINING = 50
+MIN_GRAPHQL_REMAINING = 20
+MAX_BACKOFF_SECONDS = 60
+
+CHECK_MARKS = ("✔️", "✓", "- [x]", "* [x]")
 
+# A checklist line starts with a check mark after any whitespace; one scan per comment
+# finds all of them. Lines break wherever str.splitlines() would break them.
+LINE_BREAK_CHARS = r"\n\r\v\f\x1c-\x1e\x85\u2028\u2029"
+CHECKED_LINE_RE = re.compile(
+    rf"(?:^|(?<=[{LINE_BREAK_CHARS}]))[^\S{LINE_BREAK_CHARS}]*"
+    rf"(?:{'|'.join(map(re.escape, CHECK_MARKS))})[^{LINE_BREAK_CHARS}]*"
+)
+CHECKLIST_RE = re.compile("|".join(sorted(REQUIRED_CHECKLIST)))
+PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+# Checklist lines repeat across issues and comments; normalize each distinct line once
+@lru_cache(maxsize=4096)
 def normalize(text):
     text = unicodedata.normalize("NFKD", text)
-    text = re.sub(r"[^\w\s]", "", text)
+    text = PUNCTUATION_RE.sub("", text)
     return text.lower().strip()
 
-def get_issues():
-    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/issues"
-    params = {"state": "open", "per_page": 100}
-    response = requests.get(url, headers=HEADERS, params=params)
-    response.raise_for_status()
-    return response.json()
+def parse_date(value):
+    # GitHub timestamps are always ISO 8601 in UTC with a trailing "Z"
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
-def get_issue_comments(issue_number):
-    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/issues/{issue_number}/comments"
-    response = requests.get(url, headers=HEADERS)
+class RateLimiter:
+    # Token bucket: RATE tokens per second, at most MAX_TOKENS in a burst
+    RATE = 10
+    MAX_TOKENS = 10
+
+    def __init__(self):
+        self.rate = self.RATE
+        self.tokens = self.MAX_TOKENS
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add_new_tokens(self):
+        now = time.monotonic()
+        self.tokens = min(self.MAX_TOKENS, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_for_token(self):
+        while True:
+            with self.lock:
+                self.add_new_tokens()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def calibrate(self, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        remaining = int(remaining)
+        with self.lock:
+            self.add_new_tokens()
+            if remaining < 100:
+                # Spread what is left of the budget over the time until it resets
+                seconds_to_reset = max(int(reset) - time.time(), 1)
+                self.rate = max(remaining, 1) / seconds_to_reset
+                logger.warning(f"🐢 Rate limit low ({remaining} left), throttling to {self.rate:.3f} req/s")
+            else:
+                self.rate = self.RATE
+
+# REST ("core") and GraphQL budgets are counted and reset separately, so each gets its own bucket
+RATE_LIMITERS = {"core": RateLimiter(), "graphql": RateLimiter()}
+
+# One keep-alive session for every call; all requests made here are safe to retry.
+# Everything goes to api.github.com, so one host pool sized to the worker count
+# lets every thread keep its connection instead of opening and discarding extras.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST", "PATCH"}),
+    ),
+))
+
+# url -> {"etag", "next", "body", "seen"} for conditional GETs across runs,
+# persisted together with the time of the last successful run
+ETAG_CACHE = {}
+CACHE_MAX_AGE_DAYS = 30
+# The search index lags behind edits, so the next incremental run re-checks this much before the last one
+INCREMENTAL_OVERLAP_MINUTES = 10
+
+def load_cache():
+    try:
+        with open(CACHE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_cache(cache):
+    with open(CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump(cache, f)
+
+def prune_cache(cache):
+    # Drop responses no run has asked for in a while (closed issues, short threads)
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=CACHE_MAX_AGE_DAYS)).date().isoformat()
+    return {url: entry for url, entry in cache.items() if entry["seen"] >= cutoff}
+
+def rate_limit_wait(response, attempt):
+    # Seconds to wait before retrying, or None if the response isn't a rate limit
+    if response.status_code not in (403, 429):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    reset = response.headers.get("X-RateLimit-Reset")
+    if retry_after:
+        wait = int(retry_after)
+    elif response.headers.get("X-RateLimit-Remaining") == "0" and reset:
+        wait = int(reset) - time.time()
+        if wait > MAX_BACKOFF_SECONDS:
+            # The budget is spent until a reset no capped backoff can reach; fail now
+            # instead of sleeping through every retry first
+            return None
+    elif response.status_code == 429 or "rate limit" in response.text.lower():
+        wait = 2 ** attempt
+    else:
+        # A plain 403 is a permissions problem; retrying won't help
+        return None
+    return min(max(wait, 1), MAX_BACKOFF_SECONDS)
+
+def retry_on_ratelimit(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(MAX_RATE_LIMIT_RETRIES):
+            try:
+                return func(*args, **kwargs)
+            except requests.HTTPError as e:
+                wait = rate_limit_wait(e.response, attempt)
+                if wait is None:
+                    raise
+                logger.warning(f"⏳ Rate limited ({e.response.status_code}), retrying in {wait:.0f}s")
+                time.sleep(wait)
+        return func(*args, **kwargs)
+    return wrapper
+
+@retry_on_ratelimit
+def github_request(method, url, **kwargs):
+    RATE_LIMITERS["graphql" if url.endswith("/graphql") else "core"].wait_for_token()
+    response = SESSION.request(method, url, **kwargs)
+    resource = response.headers.get("X-RateLimit-Resource")
+    if resource in RATE_LIMITERS:
+        RATE_LIMITERS[resource].calibrate(response.headers)
     response.raise_for_status()
-    return response.json()
+    return response
 
-def has_required_checklist(comments):
-    found = set()
-    for comment in comments:
-        body = comment["body"]
-        if body.startswith("**") and body.endswith("**"):
-            body = body[2:-2]
-        lines = body.splitlines()
-        for line in lines:
-            line = line.strip()
-            if line.startswith(("✔️", "✓", "- [x]", "* [x]")):
-                clean = normalize(line)
-                for item in REQUIRED_CHECKLIST:
-                    if item in clean:
-                        found.add(item)
-    print(f"📋 Found normalized checklist: {found}")
-    return REQUIRED_CHECKLIST.issubset(found)
-
-def issue_has_project_status_done(issue_node_id):
-    query = """
-    query($id: ID!) {
-      node(id: $id) {
-        ... on Issue {
-          projectItems(first: 10) {
-            nodes {
-              fieldValues(first: 10) {
-                nodes {
-                  ... on ProjectV2ItemFieldSingleSelectValue {
-                    field {
-                      ... on ProjectV2SingleSelectField {
-                        name
-                      }
-                    }
-                    name
-                  }
-                }
-              }
+ISSUES_QUERY = """
+query($q: String!, $cursor: String) {
+  search(type: ISSUE, query: $q, first: 100, after: $cursor) {
+    issueCount
+    pageInfo {
+      endCursor
+      hasNextPage
+    }
+    nodes {
+      ... on Issue {
+        id
+        number
+        title
+        createdAt
+        labels(first: 100) {
+          nodes {
+            name
+          }
+        }
+        comments(first: 50) {
+          totalCount
+          pageInfo {
+            hasNextPage
+          }
+          nodes {
+            body
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+PROJECT_STATUS_QUERY = """
+query($ids: [ID!]!, $statusField: String!) {
+  nodes(ids: $ids) {
+    ... on Issue {
+      id
+      projectItems(first: 10) {
+        nodes {
+          status: fieldValueByName(name: $statusField) {
+            ... on ProjectV2ItemFieldSingleSelectValue {
+              name
             }
           }
         }
       }
     }
-    """
+  }
+}
+"""
+
+LABEL_ID_QUERY = """
+query($owner: String!, $name: String!, $label: String!) {
+  repository(owner: $owner, name: $name) {
+    label(name: $label) {
+      id
+    }
+  }
+}
+"""
+
+CLOSE_WITH_LABELS_MUTATION = """
+mutation($issueId: ID!, $labelIds: [ID!]!) {
+  addLabelsToLabelable(input: {labelableId: $issueId, labelIds: $labelIds}) {
+    clientMutationId
+  }
+  closeIssue(input: {issueId: $issueId}) {
+    clientMutationId
+  }
+}
+"""
+
+def run_graphql(query, variables):
     url = "https://api.github.com/graphql"
-    payload = {"query": query, "variables": {"id": issue_node_id}}
-    headers = {**HEADERS, "Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    data = response.json()
-    print("📦 Project field values received")
+    payload = {"query": query, "variables": variables}
+    response = github_request("POST", url, json=payload)
+    data = json_loads(response.content)
+    if data.get("errors"):
+        raise Exception(f"❌ GraphQL query failed: {data['errors']}")
+    return data["data"]
+
+def build_search_query(updated_since=None, created_before=None, created_after=None):
+    # Comma-separated label values are OR-ed by GitHub search
+    secondary = ",".join(f'"{label}"' for label in sorted(REQUIRED_SECONDARY_LABELS))
+    query = (
+        f'repo:{REPO_OWNER}/{REPO_NAME} is:issue is:open '
+        f'label:"{REQUIRED_PRIMARY_LABEL}" label:{secondary} -label:done comments:>0 sort:created-asc'
+    )
+    if updated_since:
+        query += f" updated:>={updated_since}"
+    if created_after:
+        query += f" created:{created_after}..{created_before}"
+    elif created_before:
+        query += f" created:<={created_before}"
+    return query
+
+def fetch_issues_with_comments(cursor=None, updated_since=None, created_before=None, created_after=None):
+    variables = {
+        "q": build_search_query(updated_since, created_before, created_after),
+        "cursor": cursor,
+    }
+    return run_graphql(ISSUES_QUERY, variables)["search"]
+
+def is_truncated(page):
+    # Search stops paginating at 1000 results; newer issues are only reached once
+    # enough of the oldest ones are closed, so they may wait for many runs
+    return page["issueCount"] > SEARCH_RESULT_LIMIT
+
+def iter_search_pages(updated_since=None, created_before=None, created_after=None):
+    cursor = None
+    while True:
+        page = fetch_issues_with_comments(cursor, updated_since, created_before, created_after)
+        if cursor is None and is_truncated(page):
+            logger.warning(f"⚠️ {page['issueCount']} issues match, only the oldest {SEARCH_RESULT_LIMIT} can be listed")
+        yield page
+        if not page["pageInfo"]["hasNextPage"]:
+            return
+        cursor = page["pageInfo"]["endCursor"]
+
+def get_rate_limit():
+    # /rate_limit itself doesn't count against the limit
+    response = github_request("GET", "https://api.github.com/rate_limit")
+    return json_loads(response.content)["resources"]
+
+def estimate_cost(candidates):
+    # Upper bound: every REST comment page of each long thread and creating the close label,
+    # plus one project batch per PROJECT_STATUS_BATCH_SIZE issues, the label lookup and one
+    # close mutation per issue
+    core = 1 + sum(
+        -(-issue["comments"]["totalCount"] // COMMENTS_PER_PAGE)
+        for issue in candidates if issue["comments"]["pageInfo"]["hasNextPage"]
+    )
+    batches = -(-len(candidates) // PROJECT_STATUS_BATCH_SIZE)
+    graphql = batches + 1 + len(candidates)
+    return core, graphql
+
+def conditional_get(url, transform=None, stream=False, page_size=None):
+    # 304 responses reuse the cached body and don't count against the rate limit
+    cached = ETAG_CACHE.get(url)
+    headers = {"If-None-Match": cached["etag"]} if cached else None
+    stream = stream and ijson is not None
+    response = github_request("GET", url, headers=headers, stream=stream)
+    today = datetime.now(timezone.utc).date().isoformat()
     try:
-        nodes = data["data"]["node"]["projectItems"]["nodes"]
-        for project in nodes:
-            for field in project["fieldValues"]["nodes"]:
-                if field.get("name", "").lower().strip() == "done":
-                    return True
-    except Exception as e:
-        print(f"⚠️ Project check failed: {e}")
+        if response.status_code == 304:
+            cached["seen"] = today
+            if "Link" in response.headers:
+                return cached["body"], response.links.get("next", {}).get("url")
+            # A 304 only says this page is unchanged; a full last page may have gained a
+            # successor since it was cached, so fetch it again to learn the next link
+            if cached["next"] or page_size is None or len(cached["body"]) < page_size:
+                return cached["body"], cached["next"]
+            del ETAG_CACHE[url]
+            return conditional_get(url, transform, stream, page_size)
+
+        if stream:
+            response.raw.decode_content = True
+            body = ijson.items(response.raw, "item")
+            body = transform(body) if transform else list(body)
+        else:
+            body = json_loads(response.content)
+            if transform:
+                body = transform(body)
+    finally:
+        if stream:
+            # Hand the connection back to the pool instead of closing it
+            response.raw.drain_conn()
+            response.raw.release_conn()
+    next_url = response.links.get("next", {}).get("url")
+    if "ETag" in response.headers:
+        ETAG_CACHE[url] = {"etag": response.headers["ETag"], "next": next_url, "body": body, "seen": today}
+    return body, next_url
+
+def get_issue_comments(issue_number):
+    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/issues/{issue_number}/comments?per_page={COMMENTS_PER_PAGE}"
+    comments = []
+    # Follow the Link header; only the comment bodies are kept, both in memory and in the cache
+    while url:
+        page, url = conditional_get(
+            url, lambda page: [{"body": comment["body"]} for comment in page], stream=True, page_size=COMMENTS_PER_PAGE
+        )
+        comments.extend(page)
+    return comments
+
+def find_checklist_items(comments):
+    found = set()
+    for comment in comments:
+        body = comment["body"]
+        # Plain substring checks are far cheaper than the line regex on discussion comments
+        if not any(mark in body for mark in CHECK_MARKS):
+            continue
+        if body.startswith("**") and body.endswith("**"):
+            body = body[2:-2]
+        # finditer scans lazily, so the rest of the thread is skipped once all items are found
+        for match in CHECKED_LINE_RE.finditer(body):
+            found.update(CHECKLIST_RE.findall(normalize(match.group())))
+            # CHECKLIST_RE only matches required items, so a size check is a subset check
+            if len(found) == len(REQUIRED_CHECKLIST):
+                return found
+    return found
+
+def issue_has_project_status_done(issue):
+    for item in issue["projectItems"]["nodes"]:
+        status = item["status"] or {}
+        # An option can have a null name
+        if (status.get("name") or "").lower().strip() == "done":
+            return True
     return False
 
-def add_labels(issue_number, labels_to_add):
-    # Ensure labels_to_add is always a list
-    if isinstance(labels_to_add, str):
-        labels_to_add = [labels_to_add]
+def fetch_project_status_batch(batch):
+    return run_graphql(PROJECT_STATUS_QUERY, {"ids": batch, "statusField": PROJECT_STATUS_FIELD})
 
-    # Get current labels to avoid duplicates
-    url_get = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/issues/{issue_number}"
-    response = requests.get(url_get, headers=HEADERS)
-    response.raise_for_status()
-    existing_labels = {label["name"] for label in response.json().get("labels", [])}
+def get_project_status_done(issue_node_ids):
+    # One query per batch of issues instead of one per issue; batches run concurrently
+    batches = [
+        issue_node_ids[i:i + PROJECT_STATUS_BATCH_SIZE]
+        for i in range(0, len(issue_node_ids), PROJECT_STATUS_BATCH_SIZE)
+    ]
+    status = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for data in executor.map(fetch_project_status_batch, batches):
+            for issue in data["nodes"]:
+                # Issues deleted or transferred since the search come back as null
+                if issue is None:
+                    continue
+                status[issue["id"]] = issue_has_project_status_done(issue)
+    logger.info(f"📦 Project field values received for {len(status)} issue(s)")
+    return status
+
+def get_label_ids(label_names):
+    # Ensure label_names is always a list
+    if isinstance(label_names, str):
+        label_names = [label_names]
+
+    label_ids = []
+    for label_name in label_names:
+        variables = {"owner": REPO_OWNER, "name": REPO_NAME, "label": label_name}
+        label = run_graphql(LABEL_ID_QUERY, variables)["repository"]["label"]
+        if label:
+            label_ids.append(label["id"])
+            continue
+        # Adding a missing label through REST creates it; the GraphQL mutation needs it to exist
+        logger.info(f"🏷️ Creating missing label '{label_name}' in {REPO_OWNER}/{REPO_NAME}")
+        url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/labels"
+        response = github_request("POST", url, json={"name": label_name})
+        label_ids.append(json_loads(response.content)["node_id"])
+    return label_ids
+
+def close_with_labels(issue_node_id, label_ids):
+    # Adding labels is additive, so labels edited since the search can't be lost
+    run_graphql(CLOSE_WITH_LABELS_MUTATION, {"issueId": issue_node_id, "labelIds": label_ids})
+
+# Gates return (ok, reason) and only look at the search payload, so they cost no requests.
+# Search already filters on labels, but its index can lag behind recent label edits.
+def has_required_labels(issue):
+    mask = 0
+    for label in issue["labels"]["nodes"]:
+        mask |= LABEL_BITS.get(label["name"], 0)
+    if not mask & PRIMARY_LABEL_BIT:
+        return False, f"Missing '{REQUIRED_PRIMARY_LABEL}' label"
+    if not mask & SECONDARY_LABEL_MASK:
+        return False, f"Missing one of {', '.join(sorted(REQUIRED_SECONDARY_LABELS))}"
+    if mask & DONE_LABEL_BIT:
+        return False, "Already has 'done' label"
+    return True, None
+
+def has_comments(issue):
+    # The checklist lives in comments, so an issue without any can't pass
+    if issue["comments"]["totalCount"] == 0:
+        return False, "No comments"
+    return True, None
 
-    # Filter out labels already present
-    new_labels = [label for label in labels_to_add if label not in existing_labels]
+# Cheapest first; comment fetches and project queries only run for issues passing all of these
+PAYLOAD_GATES = (has_required_labels, has_comments)
 
-    if not new_labels:
-        print(f"ℹ️ Label(s) {labels_to_add} already present on issue #{issue_number}, skipping label addition.")
+def is_old_enough(issue, cutoff):
+    if parse_date(issue["createdAt"]) > cutoff:
+        return False, f"Created after {cutoff:%Y-%m-%dT%H:%M:%SZ}"
+    return True, None
+
+def first_failed_gate(issue, gates):
+    for gate in gates:
+        ok, reason = gate(issue)
+        if not ok:
+            return reason
+    return None
+
+def non_negative_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{value}' is not a whole number")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{number} must not be negative")
+    return number
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Close completed Normal Change Request issues.")
+    parser.add_argument(
+        "--check-project-status",
+        action="store_true",
+        default=CHECK_PROJECT_STATUS,
+        help="only close issues whose project status is 'Done' (default: $CHECK_PROJECT_STATUS)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=INCREMENTAL,
+        help="only check issues updated since the last successful run; project status changes "
+             "don't touch an issue's update time, so run a full pass now and then (default: $INCREMENTAL)",
+    )
+    parser.add_argument(
+        "--min-age-days",
+        # argparse runs string defaults through type too, so $MIN_AGE_DAYS is validated as well
+        type=non_negative_int,
+        default=MIN_AGE_DAYS or None,
+        help="only close issues created at least this many days ago (default: $MIN_AGE_DAYS, no limit)",
+    )
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+    args = parse_args(argv)
+    if not GITHUB_TOKEN or not REPO_OWNER or not REPO_NAME:
+        raise Exception("❌ GITHUB_TOKEN or REPO not set or invalid format.")
+
+    run_started_at = (datetime.now(timezone.utc) - timedelta(minutes=INCREMENTAL_OVERLAP_MINUTES)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    rate_limit = get_rate_limit()
+    if (rate_limit["core"]["remaining"] < MIN_CORE_REMAINING
+            or rate_limit["graphql"]["remaining"] < MIN_GRAPHQL_REMAINING):
+        logger.warning(f"⏸️ Not enough rate limit left (REST {rate_limit['core']['remaining']}, "
+                       f"GraphQL {rate_limit['graphql']['remaining']}), skipping this run")
         return
 
-    print(f"🏷️ Adding labels to #{issue_number}: {new_labels}")
-    url_post = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/issues/{issue_number}/labels"
-    response = requests.post(url_post, headers=HEADERS, json={"labels": new_labels})
-    response.raise_for_status()
+    cache = load_cache()
+    ETAG_CACHE.update(cache.get("responses", {}))
+    last_run = cache.get("last_run")
+    updated_since = last_run if args.incremental else None
+    if updated_since:
+        logger.info(f"⏱️ Only checking issues updated since {updated_since}\n")
 
-def close_issue(issue_number):
-    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/issues/{issue_number}"
-    print(f"🔒 Closing issue #{issue_number}")
-    response = requests.patch(url, headers=HEADERS, json={"state": "closed"})
-    response.raise_for_status()
+    gates = PAYLOAD_GATES
+    created_before = None
+    if args.min_age_days is not None:
+        cutoff = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(days=args.min_age_days)
+        created_before = cutoff.strftime("%Y-%m-%dT%H:%M:%SZ")
+        gates += (lambda issue: is_old_enough(issue, cutoff),)
+        logger.info(f"📆 Only checking issues created on or before {created_before}\n")
 
-def main():
-    issues = get_issues()
-    print(f"\n🔍 Found {len(issues)} open issues\n")
-    closed_issues = []
+    pages = iter_search_pages(updated_since, created_before)
+    if updated_since and created_before:
+        # Issues that reached the minimum age since the last run are eligible now even if
+        # nobody touched them, so list them regardless of their update time
+        aged_since = (parse_date(updated_since) - timedelta(days=args.min_age_days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        pages = chain(pages, iter_search_pages(None, created_before, aged_since))
 
-    for issue in issues:
-        issue_number = issue["number"]
-        title = issue["title"]
-        created_at = parse_date(issue["created_at"])
-        labels = {label["name"] for label in issue.get("labels", [])}
+    issue_count = 0
+    candidates = []
+    seen_ids = set()
+    truncated = False
 
-        print(f"➡️ #{issue_number}: {title}")
-        print(f"   📆 Created on: {created_at.date()}")
-        print(f"   🏷️ Labels: {labels}")
+    for page in pages:
+        truncated = truncated or is_truncated(page)
+        for issue in page["nodes"]:
+            # The two incremental searches can overlap
+            if issue["id"] in seen_ids:
+                continue
+            seen_ids.add(issue["id"])
+            issue_count += 1
+            issue_number = issue["number"]
+            title = issue["title"]
+            created_at = parse_date(issue["createdAt"])
+            issue_labels = issue["labels"]["nodes"]
 
-        if REQUIRED_PRIMARY_LABEL not in labels:
-            print("⏩ Skipped: Missing 'Normal Change Request' label\n")
-            continue
+            reason = first_failed_gate(issue, gates)
+            outcome = f"⏩ Skipped: {reason}" if reason else "🔎 Passed payload gates, queued for checklist check"
+            # One log record per issue instead of one write per line
+            logger.info(
+                f"➡️ #{issue_number}: {title}\n"
+                f"   📆 Created on: {created_at.date()}\n"
+                f"   🏷️ Labels: {', '.join(label['name'] for label in issue_labels)}\n"
+                f"{outcome}\n"
+            )
+            if not reason:
+                candidates.append(issue)
 
-        if not labels & REQUIRED_SECONDARY_LABELS:
-            print(f"⏩ Skipped: Missing one of {REQUIRED_SECONDARY_LABELS}\n")
-            continue
+    logger.info(f"\n🔍 Checked {issue_count} open issues, {len(candidates)} candidate(s)\n")
 
-        if "done" in labels:
-            print("⏩ Skipped: Already has 'done' label\n")
-            continue
+    # Stop before touching any issue rather than running out of budget halfway through
+    core_needed, graphql_needed = estimate_cost(candidates)
+    rate_limit = get_rate_limit()
+    if (rate_limit["core"]["remaining"] < core_needed
+            or rate_limit["graphql"]["remaining"] < graphql_needed):
+        logger.warning(f"⏸️ Not enough rate limit left for {len(candidates)} candidate(s) "
+                       f"(need REST {core_needed}/GraphQL {graphql_needed}, have "
+                       f"{rate_limit['core']['remaining']}/{rate_limit['graphql']['remaining']}), skipping this run")
+        return
+
+    # Only label-qualified candidates cost further network calls; fetch long threads concurrently
+    long_threads = [issue["number"] for issue in candidates if issue["comments"]["pageInfo"]["hasNextPage"]]
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        full_comments = dict(zip(long_threads, executor.map(get_issue_comments, long_threads)))
+
+    checklist_issues = []
+    for issue in candidates:
+        issue_number = issue["number"]
+        comments = full_comments.get(issue_number, issue["comments"]["nodes"])
+        found = find_checklist_items(comments)
+        complete = len(found) == len(REQUIRED_CHECKLIST)
+        outcome = "☑️ Checklist complete" if complete else "⏩ Skipped: Checklist not complete"
+        logger.info(
+            f"➡️ #{issue_number}: {issue['title']}\n"
+            f"📋 Found normalized checklist: {found}\n"
+            f"{outcome}\n"
+        )
+        if complete:
+            checklist_issues.append(issue)
 
-        comments = get_issue_comments(issue_number)
-        if not has_required_checklist(comments):
-            print("⏩ Skipped: Checklist not complete\n")
+    if args.check_project_status and checklist_issues:
+        project_status = get_project_status_done([issue["id"] for issue in checklist_issues])
+
+    issues_to_close = []
+    for issue in checklist_issues:
+        issue_number = issue["number"]
+        if args.check_project_status and not project_status.get(issue["id"]):
+            logger.info(f"⏩ Skipped #{issue_number}: Project status is not 'Done'\n")
             continue
 
-        if CHECK_PROJECT_STATUS:
-            issue_node_id = issue["node_id"]
-            if not issue_has_project_status_done(issue_node_id):
-                print("⏩ Skipped: Project status is not 'Done'\n")
-                continue
+        logger.info(f"✅ Closing issue #{issue_number} and adding labels: {LABELS_TO_ADD_ON_CLOSE}")
+        issues_to_close.append(issue)
+
+    # Close all qualifying issues concurrently; one failure must not abort the rest
+    label_ids = get_label_ids(LABELS_TO_ADD_ON_CLOSE) if issues_to_close else []
+    closed_issues = []
+    failed_issues = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(close_with_labels, issue["id"], label_ids) for issue in issues_to_close]
+        for issue, future in zip(issues_to_close, futures):
+            item = f"#{issue['number']}: {issue['title']}"
+            try:
+                future.result()
+                closed_issues.append(item)
+            except Exception as e:
+                logger.warning(f"⚠️ Failed to close issue {item}: {e}")
+                failed_issues.append(item)
+
+    # Failed closes leave their issues untouched and a truncated search never saw some
+    # issues at all, so keep the old watermark to check them again next run
+    keep_watermark = failed_issues or truncated
+    save_cache({"responses": prune_cache(ETAG_CACHE), "last_run": last_run if keep_watermark else run_started_at})
 
-        print(f"✅ Closing issue #{issue_number} and adding labels: {LABELS_TO_ADD_ON_CLOSE}\n")
-        add_labels(issue_number, LABELS_TO_ADD_ON_CLOSE)
-        close_issue(issue_number)
-        closed_issues.append(f"#{issue_number}: {title}")
+    summary = ["\n📦 Cleanup Summary", f"✅ Total issues closed: {len(closed_issues)}"]
+    summary += [f"🔒 {item}" for item in closed_issues]
+    if failed_issues:
+        summary.append(f"❌ Total issues failed: {len(failed_issues)}")
+        summary += [f"⚠️ {item}" for item in failed_issues]
+    logger.info("\n".join(summary))
 
-    print("\n📦 Cleanup Summary")
-    print(f"✅ Total issues closed: {len(closed_issues)}")
-    for item in closed_issues:
-        print(f"🔒 {item}")
+    if failed_issues:
+        raise Exception(f"❌ Failed to close {len(failed_issues)} issue(s).")
 
 if __name__ == "__main__":
     main()